@@ -5,4 +5,5 @@ from email2pdf2.email2pdf2 import \
     remove_invalid_urls, \
     get_formatted_header_info, \
     output_body_pdf, \
+    main_batch, \
     FatalException
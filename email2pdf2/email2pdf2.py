@@ -10,10 +10,13 @@ from sys import platform as _platform
 from urllib.error import URLError, HTTPError
 from urllib.request import Request, urlopen
 import argparse
-import chardet
+import binascii
+import concurrent.futures
+import contextlib
 import email
 import functools
 import html
+import importlib.util
 import io
 import locale
 import logging
@@ -30,10 +33,17 @@ import textwrap
 import traceback
 
 from PyPDF3 import PdfFileReader, PdfFileWriter
-from PyPDF3.generic import NameObject, createStringObject
-from bs4 import BeautifulSoup
+from PyPDF3.generic import DictionaryObject, IndirectObject, NameObject, NumberObject, createStringObject
+from bs4 import BeautifulSoup, SoupStrainer
 import magic
 
+# cchardet is a much faster (C) implementation of the chardet API, so use it
+# if it happens to be installed.
+try:
+    import cchardet as chardet
+except ImportError:
+    import chardet
+
 assert sys.version_info >= (3, 4)
 
 mimetypes.init()
@@ -52,6 +62,35 @@ AUTOGENERATED_ATTACHMENT_PREFIX = 'floating_attachment'
 
 IMAGE_LOAD_BLACKLIST = frozenset(['emltrk.com', 'trk.email', 'shim.gif'])
 
+IMAGE_LOAD_BLACKLIST_REGEX = re.compile('|'.join(re.escape(image_load_blacklist_item)
+                                                 for image_load_blacklist_item in IMAGE_LOAD_BLACKLIST))
+
+URL_FETCH_TIMEOUT = 5
+
+URL_FETCH_MAX_WORKERS = 16
+
+CID_REGEX = re.compile(r'cid:([\w_@.-]+)')
+
+DATE_PREFIX_REGEX = re.compile(r"\d\d\d\d[-_]\d\d[-_]\d\d")
+
+# lxml is the fastest parser for finding <img> tags, but fall back on the
+# parser built into Python if it isn't installed.
+IMG_TAG_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+IMG_TAG_REGEX = re.compile(r"""<img\b(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE)
+
+META_TAG_REGEX = re.compile(r"""<meta\b(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE)
+
+META_CHARSET_REGEX = re.compile(r"""(\bcharset\s*=\s*["']?)[^"'\s;>/]+""", re.IGNORECASE)
+
+# One attribute of a tag, with the whitespace (or '/') before it, so that
+# quoted values are skipped over rather than searched.
+TAG_ATTRIBUTE_REGEX = re.compile(r"""[\s/]*([^\s/>][^\s/>=]*)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?""")
+
+BASE64_WHITESPACE_TABLE = str.maketrans('', '', '\r\n\t ')
+
+ATTACHMENT_DECODE_CHUNK_SIZE = 65536
+
 WKHTMLTOPDF_ERRORS_IGNORE = frozenset(
     [
         r"QFont::setPixelSize: Pixel size <= 0 \(0\)",
@@ -64,18 +103,95 @@ WKHTMLTOPDF_ERRORS_IGNORE = frozenset(
     ]
 )
 
+if os.environ.get('XDG_SESSION_TYPE') == 'wayland':
+    WKHTMLTOPDF_ERRORS_IGNORE = WKHTMLTOPDF_ERRORS_IGNORE.union(
+        {r'Warning: Ignoring XDG_SESSION_TYPE=wayland on Gnome. Use QT_QPA_PLATFORM=wayland to run on Wayland anyway.'})
+
+# All the ignored errors as a single pattern, so stderr is only scanned once.
+WKHTMLTOPDF_ERRORS_IGNORE_REGEX = re.compile('|'.join('(?:' + error_pattern + ')'
+                                                      for error_pattern in WKHTMLTOPDF_ERRORS_IGNORE))
+
 WKHTMLTOPDF_EXTERNAL_COMMAND = 'wkhtmltopdf'
 
+WKHTMLTOPDF_OPTIONS = ['-q', '--load-error-handling', 'ignore', '--load-media-error-handling', 'ignore',
+                       '--encoding', 'utf-8']
+
+BATCH_MARKER_PREFIX = 'email2pdf2-batch-'
+
+BATCH_MARKER_REGEX = re.compile(re.escape(BATCH_MARKER_PREFIX) + r'(\d+)')
+
+BATCH_MARKER_HTML = '<h1 style="font-size: 0; line-height: 0; margin: 0; padding: 0;">{}</h1>'
+
+BODY_TAG_REGEX = re.compile(rb"""<body\b(?:[^>"']|"[^"]*"|'[^']*')*>""", re.IGNORECASE)
+
 
 def main(argv, syslog_handler, syserr_handler):
+    (proceed, job) = prepare_job(argv, syslog_handler, syserr_handler)
+
+    if not proceed:
+        return (False, False)
+
+    flush_jobs([job])
+
+    if job.exception:
+        raise job.exception
+
+    return (job.warning_count_filter.warning_pending, job.args.mostly_hide_warnings)
+
+
+def main_batch(argv_list, syslog_handler, syserr_handler):
+    # Converts several emails in one go. All the body PDFs are rendered by a
+    # single wkhtmltopdf invocation, so its (quite slow) start-up cost is only
+    # paid once for the whole batch. Each email succeeds or fails on its own:
+    # the returned list has, for each entry in argv_list, either a
+    # (warning_pending, mostly_hide_warnings) tuple or the FatalException that
+    # stopped that email (which has already been logged). Any other exception
+    # is unexpected, and stops the whole batch.
+    jobs = []
+    results = []
+    taken_file_names = set()
+
+    try:
+        for argv in argv_list:
+            try:
+                (proceed, job) = prepare_job(argv, syslog_handler, syserr_handler, taken_file_names)
+            except FatalException as exception:
+                log_fatal_exception(exception)
+                results.append(exception)
+                continue
+
+            if proceed:
+                taken_file_names.add(job.output_file_name)
+                jobs.append(job)
+            results.append(job)
+    except BaseException:
+        # flush_jobs() won't get to close these.
+        for job in jobs:
+            job.warning_handler.close()
+        raise
+
+    flush_jobs(jobs)
+
+    for index, result in enumerate(results):
+        if isinstance(result, Job):
+            if result.exception:
+                log_fatal_exception(result.exception)
+                results[index] = result.exception
+            else:
+                results[index] = (result.warning_count_filter.warning_pending, result.args.mostly_hide_warnings)
+        elif result is None:
+            results[index] = (False, False)
+
+    return results
+
+
+def prepare_job(argv, syslog_handler, syserr_handler, taken_file_names=frozenset()):
     logger = logging.getLogger('email2pdf2')
-    warning_count_filter = WarningCountFilter()
-    logger.addFilter(warning_count_filter)
 
     proceed, args = handle_args(argv)
 
     if not proceed:
-        return (False, False)
+        return (False, None)
 
     if args.enforce_syslog and not syslog_handler:
         raise FatalException("Required syslog socket was not found.")
@@ -108,55 +224,125 @@ def main(argv, syslog_handler, syserr_handler):
     if not os.path.exists(output_directory):
         raise FatalException("output-directory does not exist.")
 
-    output_file_name = get_output_file_name(args, output_directory)
+    output_file_name = get_output_file_name(args, output_directory, taken_file_names)
     logger.info("Output file name is: " + output_file_name)
 
-    set_up_warning_logger(logger, output_file_name)
+    job = Job(args, output_directory, output_file_name)
 
-    input_data = get_input_data(args)
-    logger.debug("Email input data is: " + input_data)
+    try:
+        prepare_job_body(job)
+    except Exception:
+        job.warning_handler.close()
+        raise
 
-    input_email = get_input_email(input_data)
-    (payload, parts_already_used) = handle_message_body(args, input_email)
-    logger.debug("Payload after handle_message_body: " + str(payload))
+    return (True, job)
 
-    if args.body:
-        payload = remove_invalid_urls(payload)
 
-        if args.headers:
-            header_info = get_formatted_header_info(input_email)
-            logger.info("Header info is: " + header_info)
-            payload = header_info + payload
+def prepare_job_body(job):
+    logger = logging.getLogger('email2pdf2')
+    args = job.args
+
+    with job.logging_context():
+        job.input_data = get_input_data(args)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Email input data is: " + str(job.input_data, args.input_encoding, errors='replace'))
+
+        job.input_email = get_input_email(job.input_data)
+        (job.payload, job.parts_already_used) = handle_message_body(args, job.input_email)
+        logger.debug("Payload after handle_message_body: " + str(job.payload))
+
+        if args.body:
+            job.payload = remove_invalid_urls(job.payload)
+
+            if args.headers:
+                header_info = get_formatted_header_info(job.input_email)
+                logger.info("Header info is: " + header_info)
+                job.payload = header_info + job.payload
 
-        logger.debug("Final payload before output_body_pdf: " + payload)
-        output_body_pdf(input_email, bytes(payload, 'UTF-8'), output_file_name)
+            logger.debug("Final payload before output_body_pdf: " + job.payload)
+
+
+def flush_jobs(jobs):
+    # Any FatalException for a job is stored on job.exception rather than
+    # raised, so that the other jobs can carry on.
+    try:
+        render_jobs([job for job in jobs if job.args.body])
+
+        for job in jobs:
+            if job.exception is None:
+                try:
+                    with job.logging_context():
+                        finish_job(job)
+                except FatalException as exception:
+                    job.exception = exception
+    finally:
+        for job in jobs:
+            job.warning_handler.close()
+
+
+def render_jobs(body_jobs):
+    logger = logging.getLogger('email2pdf2')
+
+    payloads = []
+    for job in body_jobs:
+        payloads.append(job.payload.encode('utf-8'))
+        # Only the encoded copy is needed from here on, so don't keep
+        # both in memory while rendering.
+        job.payload = None
+
+    if len(body_jobs) > 1:
+        if not wkhtmltopdf_has_patched_qt():
+            logger.info("wkhtmltopdf isn't built with patched Qt, so can't write the outline needed to render the "
+                        "emails together; rendering them one at a time.")
+        else:
+            try:
+                if render_many(payloads, [job.output_file_name for job in body_jobs]):
+                    return
+                logger.info("Could not find the start of every email in the merged PDF; rendering them one at a "
+                            "time.")
+            except FatalException as exception:
+                logger.info("Rendering the emails together failed (" + str(exception.value) + "); rendering them "
+                            "one at a time.")
+
+    for job, payload in zip(body_jobs, payloads):
+        try:
+            with job.logging_context():
+                render_html_to_pdf(payload, job.output_file_name)
+        except FatalException as exception:
+            job.exception = exception
+
+
+def finish_job(job):
+    logger = logging.getLogger('email2pdf2')
+    args = job.args
+
+    if args.body:
+        add_email_pdf_metadata(job.input_email, job.output_file_name)
 
     if args.attachments:
-        number_of_attachments = handle_attachments(input_email,
-                                                   output_directory,
+        number_of_attachments = handle_attachments(job.input_email,
+                                                   job.output_directory,
                                                    args.add_prefix_date,
                                                    args.ignore_floating_attachments,
-                                                   parts_already_used)
+                                                   job.parts_already_used)
 
     if (not args.body) and number_of_attachments == 0:
         logger.info("First try: didn't print body (on request) or extract any attachments. Retrying with filenamed parts.")
-        parts_with_a_filename = filter_filenamed_parts(parts_already_used)
+        parts_with_a_filename = filter_filenamed_parts(job.parts_already_used)
         if len(parts_with_a_filename) > 0:
-            number_of_attachments = handle_attachments(input_email,
-                                                       output_directory,
+            number_of_attachments = handle_attachments(job.input_email,
+                                                       job.output_directory,
                                                        args.add_prefix_date,
                                                        args.ignore_floating_attachments,
-                                                       set(parts_already_used - parts_with_a_filename))
+                                                       set(job.parts_already_used - parts_with_a_filename))
 
         if number_of_attachments == 0:
-            logger.warning("Second try: didn't print body (on request) and still didn't find any attachments even when looked for "
-                           "referenced ones with a filename. Giving up.")
-
-    if warning_count_filter.warning_pending:
-        with open(get_modified_output_file_name(output_file_name, "_original.eml"), 'w') as original_copy_file:
-            original_copy_file.write(input_data)
+            logger.warning("Second try: didn't print body (on request) and still didn't find any attachments even when "
+                           "looked for referenced ones with a filename. Giving up.")
 
-    return (warning_count_filter.warning_pending, args.mostly_hide_warnings)
+    if job.warning_count_filter.warning_pending:
+        with open(get_modified_output_file_name(job.output_file_name, "_original.eml"), 'wb') as original_copy_file:
+            original_copy_file.write(job.input_data)
 
 
 def handle_args(argv):
@@ -176,7 +362,8 @@ def handle_args(argv):
     parser.add_argument("--input-encoding",
                         default=locale.getpreferredencoding(), help="Set the "
                         "expected encoding of the input email (whether on stdin "
-                        "or specified with the --input-file option). If not set, "
+                        "or specified with the --input-file option). This is used "
+                        "for 8bit text parts that don't declare a charset. If not set, "
                         "defaults to this system's preferred encoding, which "
                         "is " + locale.getpreferredencoding() + ".")
 
@@ -258,13 +445,12 @@ def get_input_data(args):
     logger.debug("System encoding is: " + str(locale.getlocale()))
     logger.debug("Input encoding that will be used is " + args.input_encoding)
 
+    # MIME is bytes, so leave the decoding to the email module (and the
+    # charsets declared in the email).
     if args.input_file.strip() == "-":
-        data = ""
-        input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding=args.input_encoding)
-        for line in input_stream:
-            data += line
+        data = sys.stdin.buffer.read()
     else:
-        with open(args.input_file, "r", encoding=args.input_encoding) as input_handle:
+        with open(args.input_file, "rb") as input_handle:
             data = input_handle.read()
 
     return data
@@ -272,36 +458,57 @@ def get_input_data(args):
 
 def get_input_email(input_data):
     # Use default policy (returns email.message.EmailMessage), no more compat32 (returns email.message.Message)
-    input_email = email.message_from_string(input_data, policy=default)
+    input_email = email.message_from_bytes(input_data, policy=default)
 
-    defects = input_email.defects
-    for part in input_email.walk():
-        defects.extend(part.defects)
+    # Index the parts while walking the email for defects, so that parts can
+    # later be looked up without walking the whole email again each time. Any
+    # defect is fatal, so stop at the first part that has one.
+    input_email.parts_by_content_type = {}
+    input_email.parts_by_content_id = {}
+    input_email.parts_by_content_type_name = {}
 
-    if len(defects) > 0:
-        raise FatalException("Defects parsing email: " + pprint.pformat(defects))
+    for part in input_email.walk():
+        if len(part.defects) > 0:
+            raise FatalException("Defects parsing email: " + pprint.pformat(part.defects))
+        index_part(input_email, part)
 
     return input_email
 
 
-def get_output_file_name(args, output_directory):
+def index_part(input_email, part):
+    input_email.parts_by_content_type.setdefault(part.get_content_type(), []).append(part)
+
+    content_id = part['Content-ID']
+    if content_id is not None:
+        content_id = str(content_id)
+        input_email.parts_by_content_id.setdefault(content_id, part)
+        if content_id.startswith('<') and content_id.endswith('>'):
+            input_email.parts_by_content_id.setdefault(content_id[1:-1], part)
+
+    content_type_name = part.get_param('name', header="Content-Type")
+    if content_type_name is not None:
+        input_email.parts_by_content_type_name.setdefault(content_type_name, part)
+
+
+def get_output_file_name(args, output_directory, taken_file_names=frozenset()):
     if args.output_file:
         output_file_name = args.output_file
-        if os.path.isfile(output_file_name):
+        if os.path.isfile(output_file_name) or output_file_name in taken_file_names:
             raise FatalException("Output file " + output_file_name + " already exists.")
     else:
         output_file_name = get_unique_version(os.path.join(output_directory,
-                                                           datetime.now().strftime("%Y-%m-%dT%H-%M-%S") + ".pdf"))
+                                                           datetime.now().strftime("%Y-%m-%dT%H-%M-%S") + ".pdf"),
+                                              taken_file_names)
 
     return output_file_name
 
 
-def set_up_warning_logger(logger, output_file_name):
+def get_warning_logger(output_file_name):
     warning_logger_name = get_modified_output_file_name(output_file_name, "_warnings_and_errors.txt")
     warning_logger = logging.FileHandler(warning_logger_name, delay=True)
     warning_logger.setLevel(logging.WARNING)
     warning_logger.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-    logger.addHandler(warning_logger)
+    return warning_logger
 
 
 def get_modified_output_file_name(output_file_name, append):
@@ -323,9 +530,9 @@ def handle_message_body(args, input_email):
         else:
             raise FatalException("No body parts found; aborting.")
     elif part.get_content_type() == 'text/html':
-        (payload, cid_parts_used) = handle_html_message_body(input_email, part)
+        (payload, cid_parts_used) = handle_html_message_body(input_email, part, args.input_encoding)
     elif part.get_content_type() == 'text/plain':
-        payload = handle_plain_message_body(part)
+        payload = handle_plain_message_body(part, args.input_encoding)
     else:
         # raise FatalException("Body part not html or plain but '{}'; aborting.".format(part.get_content_type()))
         subpart = find_part_by_content_type(part, "text/html")
@@ -338,20 +545,26 @@ def handle_message_body(args, input_email):
                 else:
                     raise FatalException("No body parts found; aborting.")
             else:
-                payload = handle_plain_message_body(subpart)
+                payload = handle_plain_message_body(subpart, args.input_encoding)
         else:
-            (payload, cid_parts_used) = handle_html_message_body(input_email, subpart)  # input_email or part ?
+            (payload, cid_parts_used) = handle_html_message_body(input_email, subpart, args.input_encoding)  # input_email or part ?
 
     return payload, cid_parts_used
 
 
-def handle_plain_message_body(part):
+def handle_plain_message_body(part, input_encoding='utf-8'):
     logger = logging.getLogger("email2pdf2")
 
     if part['Content-Transfer-Encoding'] == '8bit':
-        payload = part.get_payload(decode=False)
-        assert isinstance(payload, str)
-        logger.info("Email is pre-decoded because Content-Transfer-Encoding is 8bit")
+        payload = part.get_payload(decode=True)
+        assert isinstance(payload, bytes)
+        charset = part.get_content_charset() or input_encoding
+        logger.info("Email is not transfer-encoded because Content-Transfer-Encoding is 8bit, using charset " + str(charset))
+        try:
+            payload = str(payload, charset)
+        except UnicodeDecodeError:
+            logger.warning("UnicodeDecodeErrors in plain message body, using 'replace'")
+            payload = str(payload, charset, errors='replace')
     else:
         payload = part.get_payload(decode=True)
         assert isinstance(payload, bytes)
@@ -370,15 +583,26 @@ def handle_plain_message_body(part):
                 payload = str(payload, charset, errors='replace')
 
         payload = "\n".join(    # Wrap long lines, individually
-            [ textwrap.fill(line, width=80) for line in payload.splitlines() ]
+            [ wrap_line(line) for line in payload.splitlines() ]
         )
-        payload = html.escape(payload)
+        # The body only ends up as text inside <pre>, so quotes don't need
+        # escaping, which saves two passes over it.
+        payload = html.escape(payload, quote=False)
         payload = "<html><body><pre>\n" + payload + "\n</pre></body></html>"
 
     return payload
 
 
-def handle_html_message_body(input_email, part):
+def wrap_line(line, width=80):
+    # Most lines are already short enough, and textwrap.fill() would return
+    # those unchanged (as long as they have no tabs to expand or trailing
+    # whitespace to drop), so skip it for them.
+    if len(line) <= width and '\t' not in line and not line[-1:].isspace():
+        return line
+    return textwrap.fill(line, width=width)
+
+
+def handle_html_message_body(input_email, part, input_encoding='utf-8'):
     logger = logging.getLogger("email2pdf2")
 
     cid_parts_used = set()
@@ -386,16 +610,10 @@ def handle_html_message_body(input_email, part):
     payload = part.get_payload(decode=True)
     charset = part.get_content_charset()
     if not charset:
-        charset = 'utf-8'
+        charset = input_encoding if part['Content-Transfer-Encoding'] == '8bit' else 'utf-8'
     logger.info("Determined email is HTML with charset " + str(charset))
 
-    try:
-        payload_unicode = str(payload, charset)
-    except UnicodeDecodeError:
-        detection = chardet.detect(payload)
-        charset = detection["encoding"]
-        logger.info("Detected charset can't decode body; trying again with charset " + charset)
-        payload_unicode = str(payload, charset)
+    payload_unicode = set_utf8_meta_charset(decode_html_payload(payload, charset))
 
     def cid_replace(cid_parts_used, matchobj):
         cid = matchobj.group(1)
@@ -409,53 +627,195 @@ def handle_html_message_body(input_email, part):
         if image_part is not None:
             assert image_part['Content-Transfer-Encoding'] == 'base64'
             image_base64 = image_part.get_payload(decode=False)
-            image_base64 = re.sub("[\r\n\t]", "", image_base64)
-            image_decoded = image_part.get_payload(decode=True)
-            mime_type = get_mime_type(image_decoded)
+            image_base64 = image_base64.translate(BASE64_WHITESPACE_TABLE)
+            # Only decode and sniff the image if the part doesn't already say
+            # what sort of image it is (e.g. application/octet-stream).
+            mime_type = image_part.get_content_type()
+            if image_part.get_content_maintype() != 'image':
+                mime_type = get_mime_type(image_part.get_payload(decode=True))
             cid_parts_used.add(image_part)
             return "data:" + mime_type + ";base64," + image_base64
         else:
             logger.warning("Could not find image cid " + cid + " in email content.")
             return "broken"
 
-    payload = re.sub(r'cid:([\w_@.-]+)', functools.partial(cid_replace, cid_parts_used),
-                     payload_unicode)
+    payload = CID_REGEX.sub(functools.partial(cid_replace, cid_parts_used), payload_unicode)
 
     return (payload, cid_parts_used)
 
 
-def output_body_pdf(input_email, payload, output_file_name):
+def decode_html_payload(payload, charset):
     logger = logging.getLogger("email2pdf2")
 
-    wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND, '-q', '--load-error-handling', 'ignore',
-                           '--load-media-error-handling', 'ignore', '--encoding', 'utf-8', '-',
-                           output_file_name], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    # Detecting the charset means scanning the whole body, so only do it when
+    # neither the declared charset nor UTF-8 can decode it.
+    candidates = [charset] if charset.lower() == 'utf-8' else [charset, 'utf-8']
+    for candidate in candidates:
+        try:
+            return str(payload, candidate)
+        except (UnicodeDecodeError, LookupError):
+            logger.info("Charset " + candidate + " can't decode body")
+
+    charset = chardet.detect(payload)["encoding"]
+    if charset:
+        logger.info("Trying again with detected charset " + charset)
+        try:
+            return str(payload, charset)
+        except (UnicodeDecodeError, LookupError):
+            logger.info("Detected charset " + charset + " can't decode body")
+
+    logger.info("Falling back to charset latin-1")
+    return str(payload, 'latin-1')
+
+
+def set_utf8_meta_charset(payload):
+    # The body is passed to wkhtmltopdf as UTF-8, but WebKit follows any
+    # charset declared in a <meta> tag over --encoding, so rewrite those.
+    def meta_replace(matchobj):
+        return META_CHARSET_REGEX.sub(r'\g<1>utf-8', matchobj.group(0))
+
+    return META_TAG_REGEX.sub(meta_replace, payload)
+
+
+def output_body_pdf(input_email, payload, output_file_name):
+    render_html_to_pdf(payload, output_file_name)
+    add_email_pdf_metadata(input_email, output_file_name)
+
+
+def render_html_to_pdf(payload, output_file_name):
+    wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND] + WKHTMLTOPDF_OPTIONS + ['-', output_file_name],
+                          stdin=PIPE, stdout=PIPE, stderr=PIPE)
     output, error = wkh2p_process.communicate(input=payload)
     assert output == b''
 
-    stripped_error = str(error, 'utf-8')
-    if 'XDG_SESSION_TYPE' in os.environ.keys() and os.environ['XDG_SESSION_TYPE'] == 'wayland':
-        w_err = r'Warning: Ignoring XDG_SESSION_TYPE=wayland on Gnome. Use QT_QPA_PLATFORM=wayland to run on ' \
-                r'Wayland anyway.'
-        global WKHTMLTOPDF_ERRORS_IGNORE
-        WKHTMLTOPDF_ERRORS_IGNORE = WKHTMLTOPDF_ERRORS_IGNORE.union({w_err})
+    check_wkhtmltopdf_errors(wkh2p_process.returncode, error)
+
+
+def render_many(payloads, output_file_names):
+    # wkhtmltopdf accepts several input pages on one command line, but renders
+    # them all into a single PDF. A marker heading is put at the top of each
+    # page so that the start of each one can be found again in the PDF outline,
+    # and the merged PDF is then split back into one file per payload. Returns
+    # False if that couldn't be done, in which case nothing has been written
+    # and the caller should render the payloads one at a time.
+    assert len(payloads) == len(output_file_names)
+
+    if len(payloads) == 1:
+        render_html_to_pdf(payloads[0], output_file_names[0])
+        return True
+
+    temp_directory = tempfile.mkdtemp(prefix="email2pdf2_render_many")
+
+    try:
+        command = [WKHTMLTOPDF_EXTERNAL_COMMAND] + WKHTMLTOPDF_OPTIONS + ['--outline']
+        for index, payload in enumerate(payloads):
+            page_file_name = os.path.join(temp_directory, str(index) + '.html')
+            with open(page_file_name, 'wb') as page_file:
+                page_file.write(add_batch_marker(payload, index))
+            command.append(page_file_name)
+
+        merged_file_name = os.path.join(temp_directory, 'merged.pdf')
+        command.append(merged_file_name)
+
+        wkh2p_process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        output, error = wkh2p_process.communicate()
+        assert output == b''
+
+        check_wkhtmltopdf_errors(wkh2p_process.returncode, error)
+
+        return split_merged_pdf(merged_file_name, output_file_names)
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+@functools.lru_cache(maxsize=None)
+def wkhtmltopdf_has_patched_qt():
+    # --outline (which render_many() relies on) is only supported by builds
+    # of wkhtmltopdf against its patched version of Qt.
+    try:
+        wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND, '--version'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        output, error = wkh2p_process.communicate()
+    except OSError:
+        return False
+
+    return wkh2p_process.returncode == 0 and b'with patched qt' in output.lower()
+
+
+def add_batch_marker(payload, index):
+    # Put the marker just inside <body>, so that it doesn't come before any
+    # <!DOCTYPE> and put the email into quirks mode only when batched.
+    marker = bytes(BATCH_MARKER_HTML.format(BATCH_MARKER_PREFIX + str(index)), 'UTF-8')
+
+    body_tag = BODY_TAG_REGEX.search(payload)
+    if body_tag:
+        return payload[:body_tag.end()] + marker + payload[body_tag.end():]
+    else:
+        return marker + payload
+
+
+def split_merged_pdf(merged_file_name, output_file_names):
+    with open(merged_file_name, 'rb') as merged_file:
+        pdf_input = PdfFileReader(merged_file)
+
+        # The emails' own headings are in the outline too, so only exact
+        # markers count, and each email has to start on a later page than the
+        # one before it.
+        start_pages = {}
+        for item in flatten_outline(pdf_input.getOutlines()):
+            match = BATCH_MARKER_REGEX.fullmatch(str(item.title))
+            if match:
+                start_pages.setdefault(int(match.group(1)), pdf_input.getDestinationPageNumber(item))
+
+        boundaries = [start_pages.get(index) for index in range(len(output_file_names))]
+        if None in boundaries or boundaries[0] != 0:
+            return False
+        boundaries.append(pdf_input.getNumPages())
+        if any(boundaries[index] >= boundaries[index + 1] for index in range(len(output_file_names))):
+            return False
+
+        for index, output_file_name in enumerate(output_file_names):
+            pdf_output = PdfFileWriter()
+            for page in range(boundaries[index], boundaries[index + 1]):
+                pdf_output.addPage(pdf_input.getPage(page))
+
+            with open(output_file_name, 'wb') as file_out:
+                pdf_output.write(file_out)
+
+    return True
+
+
+def flatten_outline(outline):
+    for item in outline:
+        if isinstance(item, list):
+            yield from flatten_outline(item)
+        else:
+            yield item
+
+
+def check_wkhtmltopdf_errors(returncode, error):
+    logger = logging.getLogger("email2pdf2")
+
+    original_error = str(error, 'utf-8', errors='replace').rstrip()
+
+    if returncode == 0 and original_error == '':
+        return
 
-    for error_pattern in WKHTMLTOPDF_ERRORS_IGNORE:
-        (stripped_error, number_of_subs_made) = re.subn(error_pattern, '', stripped_error)
-        if number_of_subs_made > 0:
-            logger.debug("Made " + str(number_of_subs_made) + " subs with pattern " + error_pattern)
+    (stripped_error, number_of_subs_made) = WKHTMLTOPDF_ERRORS_IGNORE_REGEX.subn('', original_error)
+    if number_of_subs_made > 0:
+        logger.debug("Made " + str(number_of_subs_made) + " subs with ignored error patterns")
 
-    original_error = str(error, 'utf-8').rstrip()
     stripped_error = stripped_error.rstrip()
 
-    if wkh2p_process.returncode > 0 and original_error == '':
-        raise FatalException("wkhtmltopdf failed with exit code " + str(wkh2p_process.returncode) + ", no error output.")
-    elif wkh2p_process.returncode > 0 and stripped_error != '':
-        raise FatalException("wkhtmltopdf failed with exit code " + str(wkh2p_process.returncode) + ", stripped error: " +
+    if returncode > 0 and original_error == '':
+        raise FatalException("wkhtmltopdf failed with exit code " + str(returncode) + ", no error output.")
+    elif returncode > 0 and stripped_error != '':
+        raise FatalException("wkhtmltopdf failed with exit code " + str(returncode) + ", stripped error: " +
                              stripped_error)
     elif stripped_error != '':
         raise FatalException("wkhtmltopdf exited with rc = 0 but produced unknown stripped error output " + stripped_error)
 
+
+def add_email_pdf_metadata(input_email, output_file_name):
     add_metadata_obj = {}
 
     for key in HEADER_MAPPING:
@@ -470,41 +830,69 @@ def output_body_pdf(input_email, payload, output_file_name):
 def remove_invalid_urls(payload):
     logger = logging.getLogger("email2pdf2")
 
-    soup = BeautifulSoup(payload, "html5lib")
+    # Only <img> tags need to be looked at, so rather than building (and then
+    # re-serializing) a tree for the whole document, just parse those to find
+    # which src attributes need removing, then remove them from the original
+    # HTML.
+    soup = BeautifulSoup(payload, IMG_TAG_PARSER, parse_only=SoupStrainer('img'))
+
+    srcs_to_remove = set()
+    srcs_to_fetch = []
 
     for img in soup.find_all('img'):
         if img.has_attr('src'):
             src = img['src']
             lower_src = src.lower()
             if lower_src == 'broken':
-                del img['src']
+                srcs_to_remove.add(src)
             elif not lower_src.startswith('data'):
-                found_blacklist = False
-
-                for image_load_blacklist_item in IMAGE_LOAD_BLACKLIST:
-                    if image_load_blacklist_item in lower_src:
-                        found_blacklist = True
-
-                if not found_blacklist:
-                    logger.debug("Getting img URL " + src)
-
-                    if not can_url_fetch(src):
-                        logger.warning("Could not retrieve img URL " + src + ", replacing with blank.")
-                        del img['src']
+                if not IMAGE_LOAD_BLACKLIST_REGEX.search(lower_src):
+                    if src not in srcs_to_fetch:
+                        srcs_to_fetch.append(src)
                 else:
                     logger.debug("Removing URL that was found in blacklist " + src)
-                    del img['src']
+                    srcs_to_remove.add(src)
             else:
                 logger.debug("Ignoring URL " + src)
 
-    return str(soup)
+    # Checking URLs is dominated by network latency, so check them all at once.
+    if len(srcs_to_fetch) > 0:
+        logger.debug("Getting img URLs " + ", ".join(srcs_to_fetch))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=URL_FETCH_MAX_WORKERS) as executor:
+            fetchable = dict(zip(srcs_to_fetch, executor.map(can_url_fetch, srcs_to_fetch)))
+
+        for src in srcs_to_fetch:
+            if not fetchable[src]:
+                logger.warning("Could not retrieve img URL " + src + ", replacing with blank.")
+                srcs_to_remove.add(src)
+
+    if len(srcs_to_remove) == 0:
+        return payload
+
+    def src_remove(matchobj):
+        if matchobj.group(1).lower() == 'src':
+            src = next((value for value in matchobj.group(2, 3, 4) if value is not None), '')
+            if html.unescape(src) in srcs_to_remove:
+                return ''
+        return matchobj.group(0)
+
+    def img_replace(matchobj):
+        tag = matchobj.group(0)
+        return tag[:4] + TAG_ATTRIBUTE_REGEX.sub(src_remove, tag[4:-1]) + tag[-1]
+
+    return IMG_TAG_REGEX.sub(img_replace, payload)
 
 
 def can_url_fetch(src):
+    encoded_src = src.replace(" ", "%20")
     try:
-        encoded_src = src.replace(" ", "%20")
-        req = Request(encoded_src)
-        urlopen(req, timeout=15)  # Reduced timeout to avoid long try on broken external link
+        try:
+            urlopen(Request(encoded_src, method='HEAD'), timeout=URL_FETCH_TIMEOUT).close()
+        except HTTPError as http_error:
+            # Some servers don't support HEAD, so try those again with GET.
+            if http_error.code not in (405, 501):
+                raise
+            urlopen(Request(encoded_src), timeout=URL_FETCH_TIMEOUT).close()
     except HTTPError:
         return False
     except URLError:
@@ -540,7 +928,7 @@ def handle_attachments(input_email, output_directory, add_prefix_date, ignore_fl
         assert filename is not None
 
         if add_prefix_date:
-            if not re.search(r"\d\d\d\d[-_]\d\d[-_]\d\d", filename):
+            if not DATE_PREFIX_REGEX.search(filename):
                 filename = datetime.now().strftime("%Y-%m-%d-") + filename
 
         logger.info("Extracting attachment " + filename)
@@ -548,49 +936,136 @@ def handle_attachments(input_email, output_directory, add_prefix_date, ignore_fl
         full_filename = os.path.join(output_directory, filename)
         full_filename = get_unique_version(full_filename)
 
-        payload = part.get_payload(decode=True)
         with open(full_filename, 'wb') as output_file:
-            output_file.write(payload)
+            stream_decode_part(part, output_file)
 
     return len(parts)
 
 
+def stream_decode_part(part, output_file):
+    # Decode base64 attachments a chunk at a time straight into the output
+    # file, rather than holding the whole decoded attachment in memory.
+    # Anything else (or anything the chunked decoding can't cope with) is
+    # left to the email module to decode.
+    if str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        payload = part.get_payload(decode=False)
+        remainder = ''
+        try:
+            for start in range(0, len(payload), ATTACHMENT_DECODE_CHUNK_SIZE):
+                chunk = remainder + payload[start:start + ATTACHMENT_DECODE_CHUNK_SIZE].translate(BASE64_WHITESPACE_TABLE)
+                usable_length = len(chunk) - len(chunk) % 4
+                output_file.write(binascii.a2b_base64(chunk[:usable_length]))
+                remainder = chunk[usable_length:]
+
+            if remainder:
+                output_file.write(binascii.a2b_base64(remainder + '=' * (-len(remainder) % 4)))
+            return
+        except (binascii.Error, ValueError):
+            output_file.seek(0)
+            output_file.truncate()
+
+    output_file.write(part.get_payload(decode=True))
+
+
 def add_update_pdf_metadata(filename, update_dictionary):
-    # This seems to be the only way to modify the existing PDF metadata.
-    #
-    # pylint: disable=protected-access, no-member
+    # The document information dictionary is only referenced from the
+    # trailer, so rather than re-writing the whole PDF, append an incremental
+    # update (see section 7.5.6 of the PDF specification) containing a new
+    # information dictionary, a cross-reference section for it and a new
+    # trailer.
 
     def add_prefix(value):
         return '/' + value
 
     full_update_dictionary = {add_prefix(k): v for k, v in update_dictionary.items()}
 
-    with open(filename, 'rb') as input_file:
-        pdf_input = PdfFileReader(input_file)
-        pdf_output = PdfFileWriter()
-
-        for page in range(pdf_input.getNumPages()):
-            pdf_output.addPage(pdf_input.getPage(page))
+    temp_file_name = None
 
-        info_dict = pdf_output._info.getObject()
+    with open(filename, 'r+b') as pdf_file:
+        pdf_input = PdfFileReader(pdf_file)
 
         info = pdf_input.documentInfo
+        if info is not None:
+            full_update_dictionary = dict(chain(info.items(), full_update_dictionary.items()))
 
-        full_update_dictionary = dict(chain(info.items(), full_update_dictionary.items()))
-
+        info_dict = DictionaryObject()
         for key in full_update_dictionary:
             assert full_update_dictionary[key] is not None
             info_dict.update({NameObject(key): createStringObject(full_update_dictionary[key])})
 
-        os_file_out, temp_file_name = tempfile.mkstemp(prefix="email2pdf2_add_update_pdf_metadata", suffix=".pdf")
-        # Immediately close the file as created to work around issue on
-        # Windows where file cannot be opened twice.
-        os.close(os_file_out)
+        previous_xref = get_startxref(pdf_file)
+        pdf_file.seek(previous_xref)
+        if pdf_file.read(4) != b'xref' or pdf_input.isEncrypted:
+            # Cross-reference streams (or encryption) would need the update
+            # written differently, so fall back on re-writing the whole PDF.
+            temp_file_name = write_pdf_with_metadata(pdf_input, info_dict, os.path.dirname(filename))
+        else:
+            write_pdf_metadata_update(pdf_file, pdf_input.trailer, previous_xref, info_dict)
+
+    # The original file is closed by now, and the temporary file is in the same
+    # directory, so this is an atomic rename rather than a copy.
+    if temp_file_name:
+        os.replace(temp_file_name, filename)
+
+
+def write_pdf_metadata_update(pdf_file, trailer, previous_xref, info_dict):
+    info_number = trailer['/Size']
+
+    update = io.BytesIO()
+    pdf_file.seek(0, os.SEEK_END)
+    update_start = pdf_file.tell()
+
+    update.write(b'\n')
+    info_offset = update_start + update.tell()
+    update.write(bytes(str(info_number) + ' 0 obj\n', 'ascii'))
+    info_dict.writeToStream(update, None)
+    update.write(b'\nendobj\n')
+
+    xref_offset = update_start + update.tell()
+    update.write(bytes('xref\n0 1\n0000000000 65535 f \n' + str(info_number) + ' 1\n' +
+                       '%010d 00000 n \n' % info_offset, 'ascii'))
+
+    new_trailer = DictionaryObject()
+    for key in ('/Root', '/ID'):
+        if key in trailer:
+            new_trailer[NameObject(key)] = trailer.raw_get(key)
+    new_trailer.update({NameObject('/Size'): NumberObject(info_number + 1),
+                        NameObject('/Info'): IndirectObject(info_number, 0, None),
+                        NameObject('/Prev'): NumberObject(previous_xref)})
+    update.write(b'trailer\n')
+    new_trailer.writeToStream(update, None)
+    update.write(bytes('\nstartxref\n' + str(xref_offset) + '\n%%EOF\n', 'ascii'))
+
+    pdf_file.write(update.getvalue())
+
+
+def get_startxref(pdf_file):
+    pdf_file.seek(0, os.SEEK_END)
+    pdf_file.seek(max(0, pdf_file.tell() - 1024))
+    tail = pdf_file.read()
+    position = tail.rindex(b'startxref')
+    return int(tail[position + len(b'startxref'):].split()[0])
 
-        with open(temp_file_name, 'wb') as file_out:
-            pdf_output.write(file_out)
 
-    shutil.move(temp_file_name, filename)
+def write_pdf_with_metadata(pdf_input, info_dict, directory):
+    # pylint: disable=protected-access
+    pdf_output = PdfFileWriter()
+
+    for page in range(pdf_input.getNumPages()):
+        pdf_output.addPage(pdf_input.getPage(page))
+
+    pdf_output._info.getObject().update(info_dict)
+
+    os_file_out, temp_file_name = tempfile.mkstemp(dir=directory or None, prefix=".email2pdf2_add_update_pdf_metadata",
+                                                   suffix=".pdf")
+    # Immediately close the file as created to work around issue on
+    # Windows where file cannot be opened twice.
+    os.close(os_file_out)
+
+    with open(temp_file_name, 'wb') as file_out:
+        pdf_output.write(file_out)
+
+    return temp_file_name
 
 
 def extract_part_filename(part):
@@ -598,27 +1073,51 @@ def extract_part_filename(part):
     filename = part.get_filename()
     if filename is not None:
         logger.debug("Pre-decoded filename: " + filename)
-        if decode_header(filename)[0][1] is not None:
-            logger.debug("Encoding: " + str(decode_header(filename)[0][1]))
-            logger.debug("Filename in bytes: " + str(decode_header(filename)[0][0]))
-            filename = str(decode_header(filename)[0][0], (decode_header(filename)[0][1]))
+        (filename_bytes, encoding) = decode_header(filename)[0]
+        if encoding is not None:
+            logger.debug("Encoding: " + str(encoding))
+            logger.debug("Filename in bytes: " + str(filename_bytes))
+            filename = str(filename_bytes, encoding)
             logger.debug("Post-decoded filename: " + filename)
         return filename
     else:
         return None
 
 
-def get_unique_version(filename):
-    # From here: http://stackoverflow.com/q/183480/27641
+def get_unique_version(filename, taken_file_names=frozenset()):
+    # From here: http://stackoverflow.com/q/183480/27641. The directory is
+    # only listed once there is a collision, to skip names already in use
+    # without checking each one in turn. The chosen name is still checked with
+    # isfile(), which also catches case variants on case-insensitive
+    # filesystems.
+    if not os.path.isfile(filename) and filename not in taken_file_names:
+        return filename
+
+    try:
+        with os.scandir(os.path.dirname(filename) or '.') as entries:
+            existing_files = {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        existing_files = set()
+
     counter = 1
     file_name_parts = os.path.splitext(filename)
-    while os.path.isfile(filename):
+    while True:
         filename = file_name_parts[0] + '_' + str(counter) + file_name_parts[1]
         counter += 1
-    return filename
+        if (os.path.basename(filename) not in existing_files and filename not in taken_file_names and
+                not os.path.isfile(filename)):
+            return filename
+
+
+# The find_part_by_* functions use the indexes built by get_input_email() when
+# they are available, and fall back on walking the message otherwise (for
+# example, when searching within a single part).
 
 
 def find_part_by_content_type_name(message, content_type_name):
+    if hasattr(message, 'parts_by_content_type_name'):
+        return message.parts_by_content_type_name.get(content_type_name)
+
     for part in message.walk():
         if part.get_param('name', header="Content-Type") == content_type_name:
             return part
@@ -626,6 +1125,10 @@ def find_part_by_content_type_name(message, content_type_name):
 
 
 def find_part_by_content_type(message, content_type):
+    if hasattr(message, 'parts_by_content_type'):
+        parts = message.parts_by_content_type.get(content_type)
+        return parts[0] if parts else None
+
     for part in message.walk():
         if part.get_content_type() == content_type:
             return part
@@ -633,6 +1136,9 @@ def find_part_by_content_type(message, content_type):
 
 
 def find_part_by_content_id(message, content_id):
+    if hasattr(message, 'parts_by_content_id'):
+        return message.parts_by_content_id.get(content_id)
+
     for part in message.walk():
         if part['Content-ID'] in (content_id, '<' + content_id + '>'):
             return part
@@ -659,11 +1165,12 @@ def get_content_disposition(part):
     return c_d
 
 
+@functools.lru_cache(maxsize=128)
 def get_type_extension(content_type):
     filetypes = set(mimetypes.guess_all_extensions(content_type)) - AUTOCALCULATED_FILENAME_EXTENSION_BLACKLIST
 
     if len(filetypes) > 0:
-        return sorted(list(filetypes))[0]
+        return min(filetypes)
     else:
         return None
 
@@ -704,25 +1211,41 @@ def get_formatted_header_info(input_email):
 # this function abstracts that out. The first clause is for `pip3 install
 # python-magic`, and the second is for the Ubuntu package python3-magic.
 
+MAGIC_FROM_BUFFER = getattr(magic, 'from_buffer', None)
+
 
 def get_mime_type(buffer_data):
-    # pylint: disable=no-member
-    if 'from_buffer' in dir(magic):
-        mime_type = magic.from_buffer(buffer_data, mime=True)
+    if MAGIC_FROM_BUFFER is not None:
+        mime_type = MAGIC_FROM_BUFFER(buffer_data, mime=True)
         if type(mime_type) is not str:
             # Older versions of python-magic seem to output bytes for the
             # mime_type name. As of Python 3.6+, it seems to be outputting
             # strings directly.
-            mime_type = str(magic.from_buffer(buffer_data, mime=True), 'utf-8')
+            mime_type = str(mime_type, 'utf-8')
     else:
-        m_handle = magic.open(magic.MAGIC_MIME_TYPE)
-        m_handle.load()
-        mime_type = m_handle.buffer(buffer_data)
+        mime_type = get_magic_handle().buffer(buffer_data)
 
     return mime_type
 
 
+@functools.lru_cache(maxsize=None)
+def get_magic_handle():
+    # Loading the magic database is expensive, so only do it once.
+    #
+    # pylint: disable=no-member
+    m_handle = magic.open(magic.MAGIC_MIME_TYPE)
+    m_handle.load()
+    return m_handle
+
+
 def get_utf8_header(header):
+    # The same headers (e.g. From) are used both for the PDF metadata and the
+    # formatted headers, so cache the decoding.
+    return decode_utf8_header(str(header))
+
+
+@functools.lru_cache(maxsize=128)
+def decode_utf8_header(header):
     # There is a simpler way of doing this here:
     # http://stackoverflow.com/a/21715870/27641. However, it doesn't seem to
     # work, as it inserts a space between certain elements in the string
@@ -741,6 +1264,39 @@ def get_utf8_header(header):
     return hdr
 
 
+class Job:
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, args, output_directory, output_file_name):
+        self.args = args
+        self.output_directory = output_directory
+        self.output_file_name = output_file_name
+        self.input_data = None
+        self.input_email = None
+        self.payload = None
+        self.parts_already_used = set()
+        self.warning_count_filter = WarningCountFilter()
+        self.warning_handler = get_warning_logger(output_file_name)
+        self.exception = None
+
+    @contextlib.contextmanager
+    def logging_context(self):
+        # Only count and record warnings against this job while it is being
+        # worked on, so that jobs in the same batch don't share warning files.
+        logger = logging.getLogger("email2pdf2")
+        logger.addFilter(self.warning_count_filter)
+        logger.addHandler(self.warning_handler)
+        try:
+            yield
+        except FatalException as exception:
+            # Remember where this job's warnings go, so that the error can
+            # be logged there too once it has been handled.
+            exception.warning_handler = self.warning_handler
+            raise
+        finally:
+            logger.removeHandler(self.warning_handler)
+            logger.removeFilter(self.warning_count_filter)
+
+
 class WarningCountFilter(logging.Filter):
     # pylint: disable=too-few-public-methods
     warning_pending = False
@@ -756,19 +1312,34 @@ class FatalException(Exception):
     def __init__(self, value):
         Exception.__init__(self, value)
         self.value = value
+        self.warning_handler = None
 
     def __str__(self):
         return repr(self.value)
 
 
-def call_main(argv, syslog_handler, syserr_handler):
-    # pylint: disable=bare-except
+def log_fatal_exception(exception):
+    # Fatal errors also go to the warnings file of the email they happened
+    # with, if it had got that far.
     logger = logging.getLogger("email2pdf2")
+    warning_handler = exception.warning_handler
 
+    if warning_handler:
+        logger.addHandler(warning_handler)
+    try:
+        logger.error(exception.value)
+    finally:
+        if warning_handler:
+            logger.removeHandler(warning_handler)
+            warning_handler.close()
+
+
+def call_main(argv, syslog_handler, syserr_handler):
+    # pylint: disable=bare-except
     try:
         (warning_pending, mostly_hide_warnings) = main(argv, syslog_handler, syserr_handler)
     except FatalException as exception:
-        logger.error(exception.value)
+        log_fatal_exception(exception)
         sys.exit(2)
     except:
         traceback.print_exc()
@@ -0,0 +1,226 @@
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from reportlab.pdfgen import canvas
+from unittest import mock
+
+import io
+import logging
+import os
+import tempfile
+
+from tests import BaseTestClasses
+
+
+class Direct_Batch(BaseTestClasses.Email2PDFTestCase):
+    def setUp(self):
+        super(Direct_Batch, self).setUp()
+        self.msg = MIMEMultipart()
+        self.email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+
+    def invokeBatch(self, messages, output_files):
+        # messages may be email.message.Message objects or raw bytes.
+        module_path = self._get_original_script_path()
+        email2pdf = self.email2pdf
+
+        input_file_handles = []
+        argv_list = []
+        for message, output_file in zip(messages, output_files):
+            input_file_handle = tempfile.NamedTemporaryFile()
+            input_file_handle.write(message if isinstance(message, bytes) else message.as_bytes())
+            input_file_handle.flush()
+            input_file_handles.append(input_file_handle)
+            argv_list.append([module_path, '-i', input_file_handle.name, '-d', self.workingDir, '-o', output_file])
+
+        stream = io.StringIO()
+        stream_handler = logging.StreamHandler(stream)
+        log = logging.getLogger('email2pdf2')
+        log.propagate = False
+        log.setLevel(logging.DEBUG)
+        log.addHandler(stream_handler)
+
+        try:
+            results = email2pdf.main_batch(argv_list, None, stream_handler)
+        finally:
+            log.removeHandler(stream_handler)
+            stream_handler.close()
+            for input_file_handle in input_file_handles:
+                input_file_handle.close()
+
+        return results, stream.getvalue()
+
+    def makeMessage(self, content):
+        message = MIMEMultipart()
+        message['From'] = self.DEFAULT_FROM
+        message['To'] = self.DEFAULT_TO
+        message['Subject'] = content
+        message.attach(MIMEText(content, 'plain'))
+        return message
+
+    def test_batch(self):
+        contents = ["First email body", "Second email body", "Third email body"]
+        paths = [os.path.join(self.workingDir, "batch" + str(index) + ".pdf") for index in range(len(contents))]
+        results, error = self.invokeBatch([self.makeMessage(content) for content in contents], paths)
+        self.assertEqual('', error)
+        self.assertEqual([(False, False)] * len(contents), results)
+        for content, path in zip(contents, paths):
+            self.assertTrue(os.path.exists(path))
+            self.assertRegex(self.getPDFText(path), content)
+            self.assertEqual(content, self.getMetadataField(path, "Title"))
+        self.assertNotRegex(self.getPDFText(paths[0]), "Second email body")
+
+    def test_batch_doctype_html(self):
+        paths = [os.path.join(self.workingDir, "batch" + str(index) + ".pdf") for index in range(2)]
+        messages = []
+        for content in ["First HTML body", "Second HTML body"]:
+            message = MIMEMultipart()
+            message['Subject'] = content
+            message.attach(MIMEText('<!DOCTYPE html>\n<html><head><title>T</title></head>'
+                                    '<body class="x"><p>' + content + '</p></body></html>', 'html'))
+            messages.append(message)
+        results, error = self.invokeBatch(messages, paths)
+        self.assertEqual('', error)
+        self.assertEqual([(False, False)] * 2, results)
+        self.assertRegex(self.getPDFText(paths[0]), "First HTML body")
+        self.assertNotRegex(self.getPDFText(paths[0]), "Second HTML body")
+        self.assertRegex(self.getPDFText(paths[1]), "Second HTML body")
+
+    def test_add_batch_marker(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        marker = bytes(email2pdf.BATCH_MARKER_HTML.format("email2pdf2-batch-3"), 'utf-8')
+        payload = b'<!DOCTYPE html>\n<html><BODY class="a>b"><p>Hi</p></BODY></html>'
+        self.assertEqual(b'<!DOCTYPE html>\n<html><BODY class="a>b">' + marker + b'<p>Hi</p></BODY></html>',
+                         email2pdf.add_batch_marker(payload, 3))
+        self.assertEqual(marker + b'<p>No body tag</p>', email2pdf.add_batch_marker(b'<p>No body tag</p>', 3))
+
+    def test_batch_same_output_file(self):
+        path = os.path.join(self.workingDir, "batch.pdf")
+        results, error = self.invokeBatch([self.makeMessage("One"), self.makeMessage("Two")], [path, path])
+        self.assertEqual((False, False), results[0])
+        self.assertIsInstance(results[1], Exception)
+        self.assertRegex(str(results[1]), "file.*exist")
+        self.assertRegex(self.getPDFText(path), "One")
+
+    def test_batch_one_email_fails(self):
+        paths = [os.path.join(self.workingDir, "batch" + str(index) + ".pdf") for index in range(2)]
+        broken_email = b"Subject: No boundary\nContent-Type: multipart/mixed\n\nSome content\n"
+        results, error = self.invokeBatch([broken_email, self.makeMessage("Good email body")], paths)
+        self.assertIsInstance(results[0], Exception)
+        self.assertRegex(str(results[0]), "(?i)defects parsing email")
+        self.assertEqual((False, False), results[1])
+        self.assertRegex(error, "(?i)defects parsing email")
+        self.assertFalse(os.path.exists(paths[0]))
+        with open(os.path.join(self.workingDir, "batch0_warnings_and_errors.txt")) as warning_file:
+            self.assertRegex(warning_file.read(), "(?i)defects parsing email")
+        self.assertRegex(self.getPDFText(paths[1]), "Good email body")
+        self.assertFalse(os.path.exists(os.path.join(self.workingDir, "batch1_warnings_and_errors.txt")))
+
+    def test_batch_unexpected_error_closes_handlers(self):
+        input_file_name = os.path.join(self.workingDir, "input.eml")
+        with open(input_file_name, 'wb') as input_file:
+            input_file.write(self.makeMessage("Some email body").as_bytes())
+        argv_list = [[self._get_original_script_path(), '-i', input_file_name, '-d', self.workingDir,
+                      '-o', os.path.join(self.workingDir, "batch" + str(index) + ".pdf")] for index in range(3)]
+        argv_list[2][2] = os.path.join(self.workingDir, "missing.eml")
+
+        warning_handlers = []
+        get_warning_logger = self.email2pdf.get_warning_logger
+
+        def record_warning_logger(output_file_name):
+            warning_handler = get_warning_logger(output_file_name)
+            warning_handler.close = mock.Mock(wraps=warning_handler.close)
+            warning_handlers.append(warning_handler)
+            return warning_handler
+
+        with mock.patch.object(self.email2pdf, 'get_warning_logger', side_effect=record_warning_logger):
+            with self.assertRaises(FileNotFoundError):
+                self.email2pdf.main_batch(argv_list, None, None)
+        self.assertEqual(3, len(warning_handlers))
+        for warning_handler in warning_handlers:
+            warning_handler.close.assert_called()
+
+    def test_batch_without_patched_qt(self):
+        contents = ["First email body", "Second email body"]
+        paths = [os.path.join(self.workingDir, "batch" + str(index) + ".pdf") for index in range(len(contents))]
+        with mock.patch.object(self.email2pdf, 'wkhtmltopdf_has_patched_qt', return_value=False), \
+                mock.patch.object(self.email2pdf, 'render_many') as render_many:
+            results, error = self.invokeBatch([self.makeMessage(content) for content in contents], paths)
+        render_many.assert_not_called()
+        self.assertEqual([(False, False)] * len(contents), results)
+        for content, path in zip(contents, paths):
+            self.assertRegex(self.getPDFText(path), content)
+
+    def test_batch_split_fails_one_render_fails(self):
+        contents = ["First email body", "Second email body", "Third email body"]
+        paths = [os.path.join(self.workingDir, "batch" + str(index) + ".pdf") for index in range(len(contents))]
+        render_html_to_pdf = self.email2pdf.render_html_to_pdf
+
+        def render_or_fail(payload, output_file_name):
+            if output_file_name == paths[1]:
+                raise self.email2pdf.FatalException("Rendering failed")
+            render_html_to_pdf(payload, output_file_name)
+
+        with mock.patch.object(self.email2pdf, 'wkhtmltopdf_has_patched_qt', return_value=True), \
+                mock.patch.object(self.email2pdf, 'render_many', return_value=False), \
+                mock.patch.object(self.email2pdf, 'render_html_to_pdf', side_effect=render_or_fail) as render_mock:
+            results, error = self.invokeBatch([self.makeMessage(content) for content in contents], paths)
+        self.assertEqual(paths, [call[0][1] for call in render_mock.call_args_list])
+        self.assertEqual((False, False), results[0])
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual((False, False), results[2])
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertRegex(self.getPDFText(paths[2]), "Third email body")
+
+    def test_wkhtmltopdf_has_patched_qt(self):
+        for (output, returncode, expected) in [(b'wkhtmltopdf 0.12.6 (with patched qt)\n', 0, True),
+                                               (b'wkhtmltopdf 0.12.6\n', 0, False),
+                                               (b'', 1, False)]:
+            self.email2pdf.wkhtmltopdf_has_patched_qt.cache_clear()
+            with mock.patch.object(self.email2pdf, 'Popen') as popen:
+                popen.return_value.communicate.return_value = (output, b'')
+                popen.return_value.returncode = returncode
+                self.assertEqual(expected, self.email2pdf.wkhtmltopdf_has_patched_qt())
+                self.assertEqual(expected, self.email2pdf.wkhtmltopdf_has_patched_qt())
+            popen.assert_called_once()
+
+        self.email2pdf.wkhtmltopdf_has_patched_qt.cache_clear()
+        with mock.patch.object(self.email2pdf, 'Popen', side_effect=FileNotFoundError):
+            self.assertFalse(self.email2pdf.wkhtmltopdf_has_patched_qt())
+        self.email2pdf.wkhtmltopdf_has_patched_qt.cache_clear()
+
+    def makeMergedPDF(self, pages):
+        # pages is a list of lists of outline titles, one list per page.
+        merged_file_name = os.path.join(self.workingDir, "merged.pdf")
+        pdf_canvas = canvas.Canvas(merged_file_name)
+        for page_number, titles in enumerate(pages):
+            pdf_canvas.drawString(0, 500, "Page " + str(page_number))
+            for title_number, title in enumerate(titles):
+                key = "page" + str(page_number) + "_" + str(title_number)
+                pdf_canvas.bookmarkPage(key)
+                pdf_canvas.addOutlineEntry(title, key, level=0)
+            pdf_canvas.showPage()
+        pdf_canvas.save()
+        return merged_file_name
+
+    def test_split_merged_pdf(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        merged_file_name = self.makeMergedPDF([["email2pdf2-batch-0", "email2pdf2-batch-notes"], [],
+                                               ["email2pdf2-batch-1", "email2pdf2-batch-2x"]])
+        paths = [os.path.join(self.workingDir, "split" + str(index) + ".pdf") for index in range(2)]
+        self.assertTrue(email2pdf.split_merged_pdf(merged_file_name, paths))
+        self.assertRegex(self.getPDFText(paths[0]), "Page 0")
+        self.assertRegex(self.getPDFText(paths[0]), "Page 1")
+        self.assertNotRegex(self.getPDFText(paths[0]), "Page 2")
+        self.assertRegex(self.getPDFText(paths[1]), "Page 2")
+
+    def test_split_merged_pdf_same_start_page(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        merged_file_name = self.makeMergedPDF([["email2pdf2-batch-0", "email2pdf2-batch-1"], []])
+        paths = [os.path.join(self.workingDir, "split" + str(index) + ".pdf") for index in range(2)]
+        self.assertFalse(email2pdf.split_merged_pdf(merged_file_name, paths))
+        self.assertFalse(os.path.exists(paths[0]))
+
+    def test_split_merged_pdf_missing_marker(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        merged_file_name = self.makeMergedPDF([["email2pdf2-batch-0"], ["email2pdf2-batch-notes"]])
+        paths = [os.path.join(self.workingDir, "split" + str(index) + ".pdf") for index in range(2)]
+        self.assertFalse(email2pdf.split_merged_pdf(merged_file_name, paths))
@@ -0,0 +1,202 @@
+from email import message_from_bytes
+from email.mime.base import MIMEBase
+from email.policy import default
+from email.mime.text import MIMEText
+from unittest import mock
+from urllib.error import HTTPError
+
+import base64
+import io
+import os
+
+from tests import BaseTestClasses
+
+
+class Direct_Helpers(BaseTestClasses.Email2PDFTestCase):
+    def setUp(self):
+        super(Direct_Helpers, self).setUp()
+        self.email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+
+    def touchInWorkingDir(self, file_name):
+        path = os.path.join(self.workingDir, file_name)
+        self.touch(path)
+        return path
+
+    def test_unique_version_no_collision(self):
+        path = os.path.join(self.workingDir, "free.pdf")
+        with mock.patch('os.scandir') as scandir:
+            self.assertEqual(path, self.email2pdf.get_unique_version(path))
+        scandir.assert_not_called()
+
+    def test_unique_version_collision(self):
+        path = self.touchInWorkingDir("taken.pdf")
+        self.touchInWorkingDir("taken_1.pdf")
+        self.assertEqual(os.path.join(self.workingDir, "taken_2.pdf"), self.email2pdf.get_unique_version(path))
+
+    def test_unique_version_taken_file_names(self):
+        path = os.path.join(self.workingDir, "batch.pdf")
+        taken_file_names = {path, os.path.join(self.workingDir, "batch_1.pdf")}
+        self.assertEqual(os.path.join(self.workingDir, "batch_2.pdf"),
+                         self.email2pdf.get_unique_version(path, taken_file_names))
+
+    def test_unique_version_case_sensitive(self):
+        path = self.touchInWorkingDir("case.pdf")
+        self.touchInWorkingDir("CASE_1.pdf")
+        if os.path.isfile(os.path.join(self.workingDir, "case_1.pdf")):
+            self.skipTest(self.workingDir + " is on a case-insensitive filesystem, test not relevant.")
+        self.assertEqual(os.path.join(self.workingDir, "case_1.pdf"), self.email2pdf.get_unique_version(path))
+
+    def test_unique_version_rechecks_candidate(self):
+        path = self.touchInWorkingDir("recheck.pdf")
+        # As a case-insensitive filesystem would report a file that is only
+        # listed under a different case.
+        taken_paths = {path, os.path.join(self.workingDir, "recheck_1.pdf")}
+        with mock.patch('os.path.isfile', side_effect=lambda candidate: candidate in taken_paths):
+            self.assertEqual(os.path.join(self.workingDir, "recheck_2.pdf"), self.email2pdf.get_unique_version(path))
+
+    def makeBase64Part(self, data, line_length=57, stray_character_offset=None):
+        encoded = str(base64.b64encode(data), 'ascii')
+        if stray_character_offset is not None:
+            encoded = encoded[:stray_character_offset] + '*' + encoded[stray_character_offset:]
+        part = MIMEBase('application', 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload('\r\n'.join(encoded[start:start + line_length] for start in range(0, len(encoded), line_length)))
+        return part
+
+    def test_stream_decode_part_multiple_chunks(self):
+        data = os.urandom(self.email2pdf.ATTACHMENT_DECODE_CHUNK_SIZE * 3 + 7)
+        part = self.makeBase64Part(data)
+        output_file = io.BytesIO()
+        with mock.patch.object(part, 'get_payload', wraps=part.get_payload) as get_payload:
+            self.email2pdf.stream_decode_part(part, output_file)
+        self.assertEqual(data, output_file.getvalue())
+        get_payload.assert_called_once_with(decode=False)
+
+    def test_stream_decode_part_stray_character(self):
+        data = os.urandom(self.email2pdf.ATTACHMENT_DECODE_CHUNK_SIZE * 2)
+        # In the middle of a group of four, after the first chunk has been decoded.
+        part = self.makeBase64Part(data, stray_character_offset=self.email2pdf.ATTACHMENT_DECODE_CHUNK_SIZE + 2)
+        output_file = io.BytesIO()
+        with mock.patch.object(part, 'get_payload', wraps=part.get_payload) as get_payload:
+            self.email2pdf.stream_decode_part(part, output_file)
+        self.assertEqual(data, output_file.getvalue())
+        get_payload.assert_called_with(decode=True)
+
+    def test_decode_html_payload_misdeclared_ascii(self):
+        payload = bytes("<p>Café</p>", 'utf-8')
+        with mock.patch.object(self.email2pdf.chardet, 'detect') as detect:
+            self.assertEqual("<p>Café</p>", self.email2pdf.decode_html_payload(payload, 'us-ascii'))
+        detect.assert_not_called()
+
+    def test_decode_html_payload_unknown_charset(self):
+        payload = bytes("<p>Café</p>", 'utf-8')
+        self.assertEqual("<p>Café</p>", self.email2pdf.decode_html_payload(payload, 'x-no-such-charset'))
+
+    def test_decode_html_payload_no_detected_charset(self):
+        payload = bytes("<p>Café</p>", 'latin-1')
+        with mock.patch.object(self.email2pdf.chardet, 'detect', return_value={'encoding': None}) as detect:
+            self.assertEqual("<p>Café</p>", self.email2pdf.decode_html_payload(payload, 'us-ascii'))
+        detect.assert_called_once_with(payload)
+
+    def test_decode_html_payload_unknown_detected_charset(self):
+        payload = bytes("<p>Café</p>", 'latin-1')
+        with mock.patch.object(self.email2pdf.chardet, 'detect', return_value={'encoding': 'x-no-such-charset'}):
+            self.assertEqual("<p>Café</p>", self.email2pdf.decode_html_payload(payload, 'utf-8'))
+
+    def invokeCanUrlFetch(self, side_effect):
+        url = "http://www.example.com/some image.jpg"
+        with mock.patch.object(self.email2pdf, 'urlopen', side_effect=side_effect) as urlopen:
+            result = self.email2pdf.can_url_fetch(url)
+        methods = [call[0][0].get_method() for call in urlopen.call_args_list]
+        for call in urlopen.call_args_list:
+            self.assertEqual("http://www.example.com/some%20image.jpg", call[0][0].full_url)
+            self.assertEqual(self.email2pdf.URL_FETCH_TIMEOUT, call[1]['timeout'])
+        return result, methods
+
+    def httpError(self, code):
+        return HTTPError("http://www.example.com/", code, "Error", {}, None)
+
+    def test_can_url_fetch_head(self):
+        self.assertEqual((True, ['HEAD']), self.invokeCanUrlFetch([mock.MagicMock()]))
+
+    def test_can_url_fetch_get_after_head_not_allowed(self):
+        for code in (405, 501):
+            self.assertEqual((True, ['HEAD', 'GET']), self.invokeCanUrlFetch([self.httpError(code), mock.MagicMock()]))
+
+    def test_can_url_fetch_get_also_fails(self):
+        self.assertEqual((False, ['HEAD', 'GET']), self.invokeCanUrlFetch([self.httpError(405), self.httpError(404)]))
+
+    def test_can_url_fetch_no_get_after_not_found(self):
+        self.assertEqual((False, ['HEAD']), self.invokeCanUrlFetch([self.httpError(404)]))
+
+    def test_remove_invalid_urls_without_lxml(self):
+        with mock.patch.object(self.email2pdf, 'IMG_TAG_PARSER', 'html.parser'):
+            payload = self.email2pdf.remove_invalid_urls('<p><img alt="x" src="broken"></p>')
+        self.assertNotIn('src', payload)
+        self.assertIn('<img alt="x"', payload)
+
+    def invokeRemoveInvalidUrls(self, payload):
+        with mock.patch.object(self.email2pdf, 'can_url_fetch', side_effect=lambda src: 'bad' not in src) as can_url_fetch:
+            payload = self.email2pdf.remove_invalid_urls(payload)
+        return payload, sorted(call[0][0] for call in can_url_fetch.call_args_list)
+
+    def test_remove_invalid_urls_quoting(self):
+        for (payload, expected) in [
+                ('<p><img src="http://example.com/bad.png" alt="a"></p>', '<p><img alt="a"></p>'),
+                ("<p><img alt='a' src='http://example.com/bad.png'></p>", "<p><img alt='a'></p>"),
+                ('<p><IMG SRC=http://example.com/bad.png alt=a></p>', '<p><IMG alt=a></p>'),
+                ('<p><img src = "http://example.com/bad.png"/></p>', '<p><img/></p>')]:
+            self.assertEqual((expected, ['http://example.com/bad.png']), self.invokeRemoveInvalidUrls(payload))
+
+    def test_remove_invalid_urls_entities(self):
+        payload = '<img src="http://example.com/bad.png?a=1&amp;b=2">'
+        self.assertEqual(('<img>', ['http://example.com/bad.png?a=1&b=2']), self.invokeRemoveInvalidUrls(payload))
+
+    def test_remove_invalid_urls_keeps_fetchable(self):
+        payload = '<img src="http://example.com/good.png"><img src="data:image/png;base64,AAAA">'
+        self.assertEqual((payload, ['http://example.com/good.png']), self.invokeRemoveInvalidUrls(payload))
+
+    def test_remove_invalid_urls_slash_before_src(self):
+        self.assertEqual(('<img>', []), self.invokeRemoveInvalidUrls('<img/src="broken">'))
+
+    def test_remove_invalid_urls_src_in_other_attribute(self):
+        payload = '<img alt="x src=broken" title=\'src="broken"\' src="broken">'
+        self.assertEqual(('<img alt="x src=broken" title=\'src="broken"\'>', []), self.invokeRemoveInvalidUrls(payload))
+
+    def test_remove_invalid_urls_blacklist(self):
+        payload = '<p>Hi</p><img src="http://emltrk.com/track.gif" width="1">'
+        self.assertEqual(('<p>Hi</p><img width="1">', []), self.invokeRemoveInvalidUrls(payload))
+
+    def test_html_body_meta_charset(self):
+        html = ('<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">'
+                '<meta charset=\'ISO-8859-1\'></head><body><p>café</p></body></html>')
+        part = MIMEText(html, 'html', 'iso-8859-1')
+        (payload, cid_parts_used) = self.email2pdf.handle_html_message_body(part, part)
+        self.assertEqual('<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8">'
+                         '<meta charset=\'utf-8\'></head><body><p>café</p></body></html>', payload)
+        self.assertEqual(set(), cid_parts_used)
+
+    def test_set_utf8_meta_charset_leaves_text(self):
+        payload = '<META CHARSET=windows-1252 /><p>charset=iso-8859-1</p>'
+        self.assertEqual('<META CHARSET=utf-8 /><p>charset=iso-8859-1</p>', self.email2pdf.set_utf8_meta_charset(payload))
+
+    def test_html_body_8bit_input_encoding(self):
+        part = message_from_bytes(b'Content-Type: text/html\r\nContent-Transfer-Encoding: 8bit\r\n\r\n'
+                                  b'<p>Caf\xe9 cr\xe8me</p>', policy=default)
+        with mock.patch.object(self.email2pdf.chardet, 'detect') as detect:
+            (payload, _) = self.email2pdf.handle_html_message_body(part, part, 'latin-1')
+        self.assertEqual('<p>Café crème</p>', payload)
+        detect.assert_not_called()
+
+    def test_plain_body_8bit_replace(self):
+        part = message_from_bytes(b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n'
+                                  b'Caf\xe9', policy=default)
+        with self.assertLogs('email2pdf2', 'WARNING') as logs:
+            payload = self.email2pdf.handle_plain_message_body(part, 'latin-1')
+        self.assertEqual('Caf\ufffd', payload.strip())
+        self.assertRegex('\n'.join(logs.output), "UnicodeDecodeErrors in plain message body")
+
+    def test_plain_body_8bit_input_encoding(self):
+        part = message_from_bytes(b'Content-Type: text/plain\r\nContent-Transfer-Encoding: 8bit\r\n\r\nCaf\xe9',
+                                  policy=default)
+        self.assertEqual('Café', self.email2pdf.handle_plain_message_body(part, 'latin-1').strip())
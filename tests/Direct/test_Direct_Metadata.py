@@ -1,6 +1,10 @@
+from PyPDF3 import PdfFileReader
 from email.message import Message
+from reportlab.pdfgen import canvas
+from unittest import mock
 
 import os
+import re
 import tempfile
 
 from tests.BaseTestClasses import Email2PDFTestCase
@@ -83,3 +87,64 @@ class Direct_Metadata(Email2PDFTestCase):
         self.assertEqual("email2pdf2", self.getMetadataField(timedFilename, "Producer"))
         self.assertFalse(self.existsByTimeWarning())
         self.assertFalse(self.existsByTimeOriginal())
+
+    def makeTwoPagePDF(self):
+        file_name = os.path.join(self.workingDir, "two_pages.pdf")
+        pdf_canvas = canvas.Canvas(file_name)
+        pdf_canvas.setTitle("Original title")
+        for page_number in range(2):
+            pdf_canvas.drawString(0, 500, "Page " + str(page_number))
+            pdf_canvas.showPage()
+        pdf_canvas.save()
+        return file_name
+
+    def getStartXref(self, file_name):
+        with open(file_name, 'rb') as pdf_file:
+            return int(re.findall(rb'startxref\s+(\d+)', pdf_file.read())[-1])
+
+    def test_incremental_metadata_updates(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        file_name = self.makeTwoPagePDF()
+        with open(file_name, 'rb') as pdf_file:
+            original_data = pdf_file.read()
+        original_xref = self.getStartXref(file_name)
+
+        email2pdf.add_update_pdf_metadata(file_name, {'Author': "First author", 'X-email2pdf-To': "to@example.com"})
+        first_xref = self.getStartXref(file_name)
+        email2pdf.add_update_pdf_metadata(file_name, {'Author': "Second author"})
+
+        with open(file_name, 'rb') as pdf_file:
+            data = pdf_file.read()
+        self.assertTrue(data.startswith(original_data))
+        self.assertEqual([original_xref, first_xref], [int(prev) for prev in re.findall(rb'/Prev (\d+)', data)])
+
+        with open(file_name, 'rb') as pdf_file:
+            pdf_input = PdfFileReader(pdf_file)
+            self.assertEqual(2, pdf_input.getNumPages())
+            self.assertEqual(first_xref, pdf_input.trailer['/Prev'])
+            self.assertEqual("Second author", pdf_input.documentInfo['/Author'])
+            self.assertEqual("to@example.com", pdf_input.documentInfo['/X-email2pdf-To'])
+            self.assertEqual("Original title", pdf_input.documentInfo['/Title'])
+
+    def test_metadata_rewrite_when_startxref_not_xref(self):
+        email2pdf = self._get_email2pdf_object(self._get_original_script_path())
+        file_name = self.makeTwoPagePDF()
+        with open(file_name, 'rb') as pdf_file:
+            data = pdf_file.read()
+        startxref = re.search(rb'startxref\s+(\d+)', data)
+        data = data[:startxref.start(1)] + bytes(str(int(startxref.group(1)) - 3), 'ascii') + data[startxref.end(1):]
+        with open(file_name, 'wb') as pdf_file:
+            pdf_file.write(data)
+
+        with mock.patch.object(email2pdf, 'write_pdf_with_metadata',
+                               wraps=email2pdf.write_pdf_with_metadata) as write_pdf_with_metadata:
+            email2pdf.add_update_pdf_metadata(file_name, {'Author': "Some author"})
+        write_pdf_with_metadata.assert_called_once()
+
+        self.assertEqual(["two_pages.pdf"], os.listdir(self.workingDir))
+        with open(file_name, 'rb') as pdf_file:
+            self.assertNotIn(b'/Prev', pdf_file.read())
+        self.assertEqual("Some author", self.getMetadataField(file_name, "Author"))
+        self.assertEqual("Original title", self.getMetadataField(file_name, "Title"))
+        with open(file_name, 'rb') as pdf_file:
+            self.assertEqual(2, PdfFileReader(pdf_file).getNumPages())
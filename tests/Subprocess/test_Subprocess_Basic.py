@@ -37,6 +37,21 @@ class TestBasic(Email2PDFTestCase):
         self.assertFalse(self.existsByTimeWarning())
         self.assertFalse(self.existsByTimeOriginal())
 
+    def test_defects_logged_to_warnings_file(self):
+        input_email = ("From: from@example.org\n"
+                       "To: to@example.org\n"
+                       "Subject: No boundary\n"
+                       "Content-Type: multipart/mixed\n"
+                       "\n"
+                       "Some content\n")
+        (rc, output, error) = self.invokeAsSubprocess(inputFile=input_email)
+        self.assertEqual(2, rc)
+        self.assertRegex(error, "(?i)defects parsing email")
+        self.assertFalse(self.existsByTime())
+        self.assertTrue(self.existsByTimeWarning())
+        self.assertRegex(self.getWarningFileContents(), "(?i)defects parsing email")
+        self.assertFalse(self.existsByTimeOriginal())
+
     def test_invalid_option(self):
         (rc, output, error) = self.invokeAsSubprocess(extraParams=['--invalid-option'])
         self.assertEqual(2, rc)